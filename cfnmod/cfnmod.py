@@ -1,18 +1,24 @@
-import contextlib
+import asyncio
 import datetime
+import errno
+import functools
 import glob
 import hashlib
 import io
 import json
 import os
+import re
 import shutil
 import stat
+import struct
 import sys
 import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
+import boto3.s3.transfer
 import botocore
 import botocore.exceptions
 import click
@@ -20,127 +26,451 @@ import yaml
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedMap, TaggedScalar, Tag
 
+try:
+    import aioboto3
+except ImportError:
+    aioboto3 = None
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
 # Create a config
-session_config = botocore.config.Config(user_agent="cfn-mod/cli")
+session_config = botocore.config.Config(
+    user_agent="cfn-mod/cli",
+    max_pool_connections=32,
+    retries={"mode": "adaptive", "max_attempts": 10},
+)
+# Multipart transfers for module artifacts
+transfer_config = boto3.s3.transfer.TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+# Algorithm used by calc_digest for newly published latest details
+DIGEST_ALGO = "sha256"
+# Modules whose lookups cost as much as one list_objects_v2 page
+LIST_PAGE_MODULES = 6
+# Error codes S3 returns for missing keys to callers without s3:ListBucket
+DENIED_CODES = ("403", "AccessDenied")
+# Returned by download_object and get_object_async when the object still
+# matches the given ETag
+NOT_MODIFIED = object()
+# Module sources compress well and level 1 keeps most of the gain for a
+# fraction of the CPU. compresslevel is only accepted from Python 3.7.
+zip_compression = {"compress_type": zipfile.ZIP_DEFLATED}
+if sys.version_info >= (3, 7):
+    zip_compression["compresslevel"] = 1
 
 
 @click.group()
 def cli():
-    pass
+    if not yaml.__with_libyaml__:
+        click.echo(
+            "libyaml is not available. Falling back to the pure-Python YAML parser.",
+            err=True,
+        )
 
 
-@contextlib.contextmanager
-def pushd(new_dir):
-    previous_dir = os.getcwd()
-    os.chdir(new_dir)
+def stat_file(path):
+    # One stat serves the regular file check, permissions and size
     try:
-        yield
-    finally:
-        os.chdir(previous_dir)
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
 
 
-def add_file(zip_file, path, in_zip_path):
-    click.echo(f"Adding path = {path}")
-    permission = 0o555 if os.access(path, os.X_OK) else 0o444
-    zip_info = zipfile.ZipInfo.from_file(in_zip_path)
-    zip_info.date_time = (2020, 1, 1, 0, 0, 0)
+def file_permission(st):
+    executable = st.st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return 0o555 if executable else 0o444
+
+
+def create_zip_info(in_zip_path, permission, size, compression=None):
+    # Fixed timestamp so archives do not depend on file mtimes
+    zip_info = zipfile.ZipInfo(in_zip_path, date_time=(2020, 1, 1, 0, 0, 0))
     zip_info.external_attr = (stat.S_IFREG | permission) << 16
-    with open(path, "rb") as fp:
-        zip_file.writestr(zip_info, fp.read())
+    # With file_size set, ZipFile picks zip64 when it is needed
+    zip_info.file_size = size
+    compression = compression or {}
+    zip_info.compress_type = compression.get("compress_type", zipfile.ZIP_STORED)
+    # ZipFile.open takes the level from the ZipInfo rather than an argument.
+    # ZipInfo only has the slot from Python 3.7, matching zip_compression.
+    if "compresslevel" in compression:
+        zip_info._compresslevel = compression["compresslevel"]
+    return zip_info
+
+
+def add_file(zip_file, path, in_zip_path, compression=None):
+    st = stat_file(path)
+    if st is None:
+        return
+    click.echo(f"Adding path = {path}")
+    zip_info = create_zip_info(
+        in_zip_path, file_permission(st), st.st_size, compression
+    )
+    with open(path, "rb") as src, zip_file.open(zip_info, "w") as dest:
+        shutil.copyfileobj(src, dest, 1024 * 1024)
+
+
+def add_data(zip_file, data, in_zip_path, compression=None):
+    click.echo(f"Adding generated path = {in_zip_path}")
+    zip_info = create_zip_info(in_zip_path, 0o444, len(data), compression)
+    with zip_file.open(zip_info, "w") as dest:
+        dest.write(data)
+
+
+@functools.lru_cache(maxsize=256)
+def _load_yaml_cached(path, mtime_ns, size):
+    with open(path, "rb") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+# Parses are reused while the file is unchanged, so returned documents are
+# shared between callers and must be treated as read-only.
+def load_yaml(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return _load_yaml_cached(path, st.st_mtime_ns, st.st_size)
 
 
 def generate_versioned_conf(folder, path, version):
-    path = Path(folder) / path
-    with open(path, "r") as f:
-        conf = yaml.load(f, Loader=yaml.FullLoader)
-    conf["module"]["version"] = version
-    f = tempfile.NamedTemporaryFile(mode="w", delete=False)
-    yaml.dump(conf, f)
-    return f.name
+    conf = load_yaml(Path(folder) / path)
+    conf = dict(conf, module=dict(conf["module"], version=version))
+    return yaml.dump(conf, Dumper=SafeDumper).encode("utf-8")
 
 
-def create_zip(files, version=None):
-    zip_bytes = io.BytesIO()
+def create_zip(files, version=None, compression=zip_compression):
+    # Small archives stay in memory, large ones spill to disk
+    zip_bytes = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
     with zipfile.ZipFile(zip_bytes, "w") as zip_file:
         for folder, files in files:
-            with pushd(folder):
-                for path in files:
-                    if version is not None and folder == "." and path == "module.yml":
-                        new_module_path = generate_versioned_conf(folder, path, version)
-                        add_file(zip_file, new_module_path, path)
-                        os.unlink(new_module_path)
-                    elif os.path.isfile(path):
-                        add_file(zip_file, path, path)
-        zip_bytes.seek(0)
-        return zip_bytes
-
-
-def calc_md5(md5_files):
-    zip_bytes = create_zip(md5_files)
-    md5hash = hashlib.md5(zip_bytes.getvalue())
+            for path in files:
+                full_path = os.path.join(folder, path)
+                if version is not None and folder == "." and path == "module.yml":
+                    module_conf = generate_versioned_conf(folder, path, version)
+                    add_data(zip_file, module_conf, path, compression)
+                else:
+                    add_file(zip_file, full_path, path, compression)
+    # Closing the ZipFile writes the central directory, so rewind afterwards
+    zip_bytes.seek(0)
+    return zip_bytes
+
+
+def new_hash(algo):
+    # The digest only fingerprints artifacts, which also keeps md5 usable on
+    # FIPS builds. usedforsecurity is only accepted from Python 3.9.
+    try:
+        return hashlib.new(algo, usedforsecurity=False)
+    except TypeError:
+        return hashlib.new(algo)
+
+
+def calc_digest(md5_files, algo=DIGEST_ALGO):
+    digest = new_hash(algo)
+    for folder, files in md5_files:
+        for path in sorted(files):
+            full_path = os.path.join(folder, path)
+            st = stat_file(full_path)
+            if st is None:
+                continue
+            digest.update(path.encode("utf-8") + b"\0")
+            digest.update(struct.pack("<IQ", file_permission(st), st.st_size))
+            with open(full_path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def calc_zip_md5(md5_files):
+    md5hash = new_hash("md5")
+    # The original md5 sums were taken over uncompressed archives
+    with create_zip(md5_files, compression=None) as zip_bytes:
+        for chunk in iter(lambda: zip_bytes.read(1024 * 1024), b""):
+            md5hash.update(chunk)
     return md5hash.hexdigest()
 
 
+# Clients are thread-safe and shared, but boto3 sessions are not, so each
+# cached client is built from its own session.
+@functools.lru_cache(maxsize=1)
+def get_client():
+    return boto3.session.Session().client("s3", config=session_config)
+
+
+@functools.lru_cache(maxsize=1)
+def get_unsigned_client():
+    s3 = boto3.session.Session().client(
+        "s3",
+        config=session_config,
+        aws_access_key_id="",
+        aws_secret_access_key="",
+        aws_session_token="",
+    )
+    s3._request_signer.sign = lambda *args, **kwargs: None
+    return s3
+
+
+def error_code(exc):
+    # The S3 error code carried by a botocore ClientError, if any
+    return getattr(exc, "response", {}).get("Error", {}).get("Code")
+
+
 def get_object(bucket, key):
-    s3 = boto3.client("s3", config=session_config)
     try:
-        s3 = boto3.client(
-            "s3",
-            config=session_config,
-            aws_access_key_id="",
-            aws_secret_access_key="",
-            aws_session_token=""
-        )
-        s3._request_signer.sign = lambda *args, **kwargs: None
+        s3 = get_unsigned_client()
         response = s3.get_object(Bucket=bucket, Key=key)
         return response
     except Exception as exc:
-        if (
-            hasattr(exc, "response")
-            and exc.response.get("Error", {}).get("Code") == "NoSuchKey"
-        ):
+        err = error_code(exc)
+        if err == "NoSuchKey":
             return None
-        elif hasattr(exc, "response") and exc.response.get("Error", {}).get("Code"):
-            err = exc.response.get("Error", {}).get("Code")
+        elif err:
             click.echo(f"Error {err}. Quitting.")
             raise
         else:
             raise
 
 
+def download_error_result(exc, missing_codes=()):
+    # The result of a download that failed with exc: NOT_MODIFIED when the
+    # object still matches the given ETag, None when it does not exist (or
+    # failed with one of missing_codes). Other errors are raised again.
+    err = error_code(exc)
+    if err in ("304", "NotModified"):
+        return NOT_MODIFIED
+    elif err in ("404", "NoSuchKey") + tuple(missing_codes):
+        return None
+    elif err:
+        click.echo(f"Error {err}. Quitting.")
+    raise exc
+
+
+def download_object(bucket, key, fileobj, if_none_match=None, missing_codes=()):
+    # Returns the object's ETag or the result of download_error_result
+    try:
+        s3 = get_unsigned_client()
+        extra = {"IfNoneMatch": if_none_match} if if_none_match else {}
+        response = s3.get_object(Bucket=bucket, Key=key, **extra)
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            fileobj.write(chunk)
+        fileobj.seek(0)
+        return response["ETag"]
+    except Exception as exc:
+        return download_error_result(exc, missing_codes)
+
+
+def list_keys(bucket, prefixes, max_pages=None):
+    # Maps each key under the prefixes to its ETag, or returns None when the
+    # listing is denied or would take more than max_pages requests
+    keys = {}
+    pages = 0
+    try:
+        paginator = get_unsigned_client().get_paginator("list_objects_v2")
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                pages += 1
+                if max_pages is not None and pages > max_pages:
+                    click.echo(
+                        f"... Bucket {bucket} is too large to list. Checking modules individually."
+                    )
+                    return None
+                keys.update(
+                    (item["Key"], item["ETag"]) for item in page.get("Contents", [])
+                )
+    except botocore.exceptions.ClientError as exc:
+        # Buckets serving modules anonymously may not allow listing
+        err = error_code(exc)
+        click.echo(
+            f"... Unable to list bucket {bucket} ({err}). Checking modules individually."
+        )
+        return None
+    return keys
+
+
+def latest_key(module_name):
+    return f"latest/{module_name}-latest.yml"
+
+
 def get_latest_details(bucket, module_name):
-    key = f"latest/{module_name}-latest.yml"
-    response = get_object(bucket, key)
+    response = get_object(bucket, latest_key(module_name))
     if response is None:
-        return None, None
+        return None, None, None
     else:
-        latest = yaml.load(response["Body"], Loader=yaml.FullLoader)
-        return latest["version"], latest["md5sum"]
+        return parse_latest_details(response["Body"])
+
+
+def parse_latest_details(stream):
+    latest = yaml.load(stream, Loader=SafeLoader)
+    if "digest" in latest:
+        return latest["version"], latest["digest"], latest["algo"]
+    # Older latest details only carry the md5sum of the artifact zip
+    return latest["version"], latest["md5sum"], "zip-md5"
+
+
+def translate_segment(segment):
+    # Wildcards never cross a path separator and, like glob, do not match a
+    # leading dot unless the segment itself starts with one.
+    if not glob.has_magic(segment):
+        return re.escape(segment)
+    regex = "" if segment.startswith(".") else r"(?!\.)"
+    i, n = 0, len(segment)
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            j = i
+            if j < n and segment[j] == "!":
+                j += 1
+            if j < n and segment[j] == "]":
+                j += 1
+            while j < n and segment[j] != "]":
+                j += 1
+            if j >= n:
+                regex += r"\["
+            else:
+                chars = segment[i:j].replace("\\", "\\\\")
+                chars = re.sub(r"([&~|\[])", r"\\\1", chars)
+                i = j + 1
+                if chars[0] == "!":
+                    chars = "^/" + chars[1:]
+                elif chars[0] == "^":
+                    chars = "\\" + chars
+                regex += f"[{chars}]"
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def translate_pattern(pattern, recursive):
+    # Returns a regex over "/"-separated file paths relative to the artifact
+    # folder with glob.glob semantics, plus the folder depth it can reach
+    # (None when a recursive "**" makes it unbounded).
+    segments = pattern.split("/")
+    regex = ""
+    max_depth = len(segments)
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if recursive and segment == "**":
+            max_depth = None
+            regex += r"(?:[^/.][^/]*/)*"
+            if last:
+                regex += r"[^/.][^/]*"
+        else:
+            regex += translate_segment(segment) + ("" if last else "/")
+    return regex, max_depth
+
+
+def list_folder(folder, max_depth=None, hidden=False):
+    # Like glob, only descend into hidden directories such as .git when a
+    # pattern names them
+    files = []
+    for root, dirs, names in os.walk(folder, followlinks=True):
+        rel_root = os.path.relpath(root, folder)
+        if rel_root == ".":
+            prefix, depth = "", 0
+        else:
+            prefix = rel_root.replace(os.sep, "/") + "/"
+            depth = prefix.count("/")
+        if max_depth is not None and depth + 1 >= max_depth:
+            dirs[:] = []
+        elif not hidden:
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+        files.extend(prefix + name for name in names)
+    return files
+
+
+def split_pattern(pattern):
+    # glob keeps a leading "./" in its results, so match the rest of the
+    # pattern and add the prefix back to the matches
+    prefix = ""
+    while pattern.startswith("./"):
+        prefix += "./"
+        pattern = pattern[2:]
+    return prefix, pattern
+
+
+def needs_glob(pattern):
+    # Patterns that leave the folder, are absolute or contain "." or empty
+    # segments cannot match the folder listing and keep glob's own matching
+    segments = pattern.split("/")
+    return os.path.isabs(pattern) or any(
+        segment in ("", ".", "..") for segment in segments
+    )
+
+
+def glob_files(folder, pattern, recursive):
+    root = os.path.join(folder, "")
+    files = []
+    for path in glob.glob(os.path.join(folder, pattern), recursive=recursive):
+        if os.path.isfile(path):
+            files.append(path if os.path.isabs(pattern) else path[len(root) :])
+    return files
 
 
 def collect_files(artifacts):
     md5 = {}
     full = {}
+    listings = {}
     for artifact_item in artifacts:
         folder = artifact_item.get("folder", ".")
-        with pushd(folder):
-            for pattern in artifact_item.get("pattern", ["*"]):
-                recursive = artifact_item.get("recursive", False)
-                click.echo(
-                    f"Collecting Folder = {folder}, Pattern = {pattern}, Recursive = {recursive}"
+        if not os.path.isdir(folder):
+            # A mistyped folder must not publish an incomplete artifact
+            raise FileNotFoundError(errno.ENOENT, "Artifact folder not found", folder)
+        recursive = artifact_item.get("recursive", False)
+        regexes = {}
+        globbed = []
+        max_depth = 0
+        hidden = False
+        for pattern in artifact_item.get("pattern", ["*"]):
+            click.echo(
+                f"Collecting Folder = {folder}, Pattern = {pattern}, Recursive = {recursive}"
+            )
+            prefix, rest = split_pattern(pattern)
+            if needs_glob(rest):
+                globbed.extend(glob_files(folder, pattern, recursive))
+                continue
+            regex, depth = translate_pattern(rest, recursive)
+            regexes.setdefault(prefix, []).append(f"(?:{regex})")
+            hidden = hidden or any(part.startswith(".") for part in rest.split("/"))
+            if depth is None or max_depth is None:
+                max_depth = None
+            else:
+                max_depth = max(max_depth, depth)
+        files = set(globbed)
+        if regexes:
+            # Match all of the item's patterns in a single pass over one walk
+            # of the folder, shared with other items needing the same depth
+            listing = (folder, max_depth, hidden)
+            if listing not in listings:
+                listings[listing] = list_folder(*listing)
+            for prefix, prefix_regexes in regexes.items():
+                matcher = re.compile("|".join(prefix_regexes))
+                files.update(
+                    prefix + path
+                    for path in listings[listing]
+                    if matcher.fullmatch(path)
                 )
-                files = sorted(glob.glob(pattern, recursive=recursive))
-                full.setdefault(folder, []).extend(files)
-                if artifact_item.get("include_in_md5", False):
-                    click.echo("Including in md5sum-able artifacts")
-                    md5.setdefault(folder, []).extend(files)
-        full[folder] = sorted(list(set(full.get(folder, []))))
-        md5[folder] = sorted(list(set(md5.get(folder, []))))
-    return sorted(full.items()), sorted(md5.items())
+        full.setdefault(folder, set()).update(files)
+        md5.setdefault(folder, set())
+        if artifact_item.get("include_in_md5", False):
+            click.echo("Including in md5sum-able artifacts")
+            md5[folder].update(files)
+    # Deduplicate into sets and sort each folder once at the end
+    return (
+        sorted((folder, sorted(files)) for folder, files in full.items()),
+        sorted((folder, sorted(files)) for folder, files in md5.items()),
+    )
 
 
-def install_module(folder, bucket, module_name, version=None):
-    path = Path(".") / folder / module_name
+def remove_module_folder(path):
     try:
         if os.path.exists(path):
             click.echo(f"... Folder {path} already exists. Removing.")
@@ -148,38 +478,191 @@ def install_module(folder, bucket, module_name, version=None):
     except Exception:
         click.echo("Error occurred removing folder. Quitting.")
         sys.exit(1)
+
+
+def module_shard(module_name):
+    # Spreading modules over up to 256 prefixes keeps bulk publishes and
+    # installs under S3's per-prefix request rates
+    return hashlib.sha256(module_name.encode("utf-8")).hexdigest()[:2]
+
+
+def module_key(module_name, version, sharded=True):
+    base = "modules/dev" if "dev" in version else "modules"
+    if not sharded:
+        return f"{base}/{module_name}-{version}.zip"
+    return f"{base}/{module_shard(module_name)}/{module_name}-{version}.zip"
+
+
+def module_keys(module_name, version):
+    # Modules published before sharding only exist under their flat key
+    return [
+        module_key(module_name, version),
+        module_key(module_name, version, sharded=False),
+    ]
+
+
+def read_installed_etag(path):
+    etag_path = Path(path) / ".etag"
+    if not os.path.isfile(etag_path):
+        return None
+    with open(etag_path, "r") as f:
+        return f.read().strip()
+
+
+def extract_module(path, module_name, zip_bytes, etag):
+    try:
+        click.echo(f"Creating folder {path} for module {module_name}")
+        os.makedirs(path)
+        click.echo("Unzipping module")
+        zip_file = zipfile.ZipFile(zip_bytes)
+        zip_file.extractall(path)
+        with open(Path(path) / ".etag", "w") as f:
+            f.write(etag)
+    except Exception as exc:
+        click.echo(f"... Error occurred creating folder or unzipping: {exc}")
+        click.echo("Quitting.")
+        sys.exit(1)
+
+
+def download_attempts(module_name, version, keys, installed_etag):
+    # The keys to download in order, each with the error codes that mean it
+    # is missing, or NOT_MODIFIED when the bucket listing shows that the
+    # installed copy came from the first listed key
+    candidates = module_keys(module_name, version)
+    flat_key = candidates[-1]
+    if keys is not None:
+        candidates = [key for key in candidates if key in keys]
+        if candidates and keys[candidates[0]] == installed_etag:
+            return NOT_MODIFIED
+    # Anonymous buckets without ListBucket answer 403 for missing keys, so a
+    # denied sharded key falls through to the flat key
+    return [(key, DENIED_CODES if key != flat_key else ()) for key in candidates]
+
+
+def skip_missing_module(path, bucket, module_name):
+    remove_module_folder(path)
+    click.echo(
+        f"Module {module_name}==latest does not exist in bucket {bucket}. Skipping."
+    )
+
+
+def finish_install(path, bucket, module_name, version, zip_bytes, etag):
+    # Applies the download result to the module folder and returns the
+    # installed version, or None when the module was not found
+    if etag is NOT_MODIFIED:
+        click.echo(f"... Module {module_name}=={version} is up-to-date.")
+        return version
+    remove_module_folder(path)
+    if etag is None:
+        click.echo(
+            f"... Module {module_name}=={version} not found in bucket {bucket}. Skipping."
+        )
+        return None
+    extract_module(path, module_name, zip_bytes, etag)
+    return version
+
+
+def install_module(folder, bucket, module_name, version=None, keys=None):
+    path = Path(".") / folder / module_name
     if version is None or version == "latest":
-        version, _ = get_latest_details(bucket, module_name)
+        version = None
+        if keys is None or latest_key(module_name) in keys:
+            version, _, _ = get_latest_details(bucket, module_name)
     if version is None:
-        version = "latest"
-        click.echo(
-            f"Module {module_name}=={version} does not exist in bucket {bucket}. Skipping."
+        return skip_missing_module(path, bucket, module_name)
+    installed_etag = read_installed_etag(path)
+    attempts = download_attempts(module_name, version, keys, installed_etag)
+    with tempfile.TemporaryFile() as zip_bytes:
+        etag = None
+        if attempts is NOT_MODIFIED:
+            etag, attempts = NOT_MODIFIED, []
+        for key, missing in attempts:
+            click.echo(f"Downloading s3://{bucket}/{key}")
+            etag = download_object(bucket, key, zip_bytes, installed_etag, missing)
+            if etag is not None:
+                break
+        return finish_install(path, bucket, module_name, version, zip_bytes, etag)
+
+
+async def get_object_async(
+    s3, bucket, key, fileobj, if_none_match=None, missing_codes=()
+):
+    # The aioboto3 counterpart of download_object
+    loop = asyncio.get_event_loop()
+    try:
+        extra = {"IfNoneMatch": if_none_match} if if_none_match else {}
+        response = await s3.get_object(Bucket=bucket, Key=key, **extra)
+        async for chunk in response["Body"].iter_chunks(1024 * 1024):
+            await loop.run_in_executor(None, fileobj.write, chunk)
+        fileobj.seek(0)
+        return response["ETag"]
+    except Exception as exc:
+        return download_error_result(exc, missing_codes)
+
+
+async def install_module_async(
+    s3, semaphore, folder, bucket, module_name, version=None, keys=None
+):
+    # Mirrors install_module with awaited requests. The semaphore only bounds
+    # S3 requests; filesystem work runs on the default executor so extraction
+    # does not block other downloads.
+    loop = asyncio.get_event_loop()
+    path = Path(".") / folder / module_name
+    if version is None or version == "latest":
+        version = None
+        if keys is None or latest_key(module_name) in keys:
+            with io.BytesIO() as latest:
+                async with semaphore:
+                    etag = await get_object_async(
+                        s3, bucket, latest_key(module_name), latest
+                    )
+                if etag is not None:
+                    version, _, _ = parse_latest_details(latest)
+    if version is None:
+        return await loop.run_in_executor(
+            None, skip_missing_module, path, bucket, module_name
+        )
+    installed_etag = await loop.run_in_executor(None, read_installed_etag, path)
+    attempts = download_attempts(module_name, version, keys, installed_etag)
+    with tempfile.TemporaryFile() as zip_bytes:
+        etag = None
+        if attempts is NOT_MODIFIED:
+            etag, attempts = NOT_MODIFIED, []
+        for key, missing in attempts:
+            click.echo(f"Downloading s3://{bucket}/{key}")
+            async with semaphore:
+                etag = await get_object_async(
+                    s3, bucket, key, zip_bytes, installed_etag, missing
+                )
+            if etag is not None:
+                break
+        return await loop.run_in_executor(
+            None, finish_install, path, bucket, module_name, version, zip_bytes, etag
+        )
+
+
+async def install_modules_async(bucket, mods, keys=None):
+    concurrency = int(os.environ.get("CFN_MOD_CONCURRENCY", "64"))
+    semaphore = asyncio.Semaphore(concurrency)
+    config = session_config.merge(
+        botocore.config.Config(
+            signature_version=botocore.UNSIGNED, max_pool_connections=concurrency
         )
-        return
-    key = (
-        f"modules/dev/{module_name}-{version}.zip"
-        if "dev" in version
-        else f"modules/{module_name}-{version}.zip"
     )
-    click.echo(f"Downloading s3://{bucket}/{key}")
-    response = get_object(bucket, key)
-    if response is None:
-        click.echo(
-            f"... Module {module_name}=={version} not found in bucket {bucket}. Skipping."
+    async with aioboto3.Session().client("s3", config=config) as s3:
+        await asyncio.gather(
+            *[
+                install_module_async(s3, semaphore, "modules", bucket, *mod, keys=keys)
+                for mod in mods
+            ]
         )
-        return
-    else:
-        try:
-            click.echo(f"Creating folder {path} for module {module_name}")
-            os.makedirs(path)
-            click.echo("Unzipping module")
-            zip_file = zipfile.ZipFile(io.BytesIO(response["Body"].read()))
-            zip_file.extractall(path)
-            return version
-        except Exception as exc:
-            click.echo(f"... Error occurred creating folder or unzipping: {exc}")
-            click.echo("Quitting.")
-            sys.exit(1)
+
+
+def run_async(coroutine):
+    # asyncio.run is only available from Python 3.7
+    if sys.version_info >= (3, 7):
+        return asyncio.run(coroutine)
+    return asyncio.get_event_loop().run_until_complete(coroutine)
 
 
 def add_resource_and_outputs(
@@ -285,8 +768,7 @@ def freeze():
                     err=True,
                 )
                 continue
-            with open(module_conf_file, "r") as f:
-                conf = yaml.load(f, Loader=yaml.FullLoader)
+            conf = load_yaml(module_conf_file)
             module_name = conf["module"]["name"]
             version = conf["module"]["version"]
             click.echo(f"{module_name}=={version}")
@@ -294,8 +776,7 @@ def freeze():
 
 def get_mod_path(modules_path, module_name):
     path = Path(modules_path) / module_name / "module.yml"
-    with open(path, "r") as f:
-        conf = yaml.load(f, Loader=yaml.FullLoader)
+    conf = load_yaml(path)
     entrypoint = conf["module"]["entrypoint"]
     return Path(modules_path) / module_name / entrypoint, entrypoint
 
@@ -358,8 +839,14 @@ def add(bucket, template, module):
 @cli.command()
 @click.option("--bucket", "-b", required=True)
 @click.option("--modules-file", "-f", type=click.File("r"))
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Download modules with asyncio and aioboto3 instead of threads.",
+)
 @click.argument("module", nargs=-1)
-def install(bucket, modules_file, module):
+def install(bucket, modules_file, use_async, module):
     if not module and not modules_file:
         click.echo("No module or modules file supplied. Exiting without action.")
         sys.exit(1)
@@ -369,23 +856,50 @@ def install(bucket, modules_file, module):
         )
         sys.exit(1)
     mod_iter = module if module else modules_file
+    # Modules install concurrently into per-module folders, so each module is
+    # installed once, with the last requested version winning
+    versions = {}
     for mod in mod_iter:
         mod = mod.strip()
         if "==" in mod:
             module_name, version = mod.split("==")
             click.echo(f"Installing module {module_name}=={version}")
-            install_module("modules", bucket, module_name, version)
+            versions[module_name] = version
         else:
             click.echo(f"Installing module {mod}")
-            install_module("modules", bucket, mod)
+            versions[mod] = None
+    mods = list(versions.items())
+    # A listing page costs about as much as a dozen GETs and each module needs
+    # about two lookups, so only list while that stays cheaper
+    max_pages = len(mods) // LIST_PAGE_MODULES
+    keys = None
+    if max_pages >= 2:
+        keys = list_keys(bucket, ["latest/", "modules/"], max_pages)
+    if use_async and aioboto3 is None:
+        click.echo("aioboto3 is not installed. Falling back to threads.", err=True)
+        use_async = False
+    if use_async:
+        run_async(install_modules_async(bucket, mods, keys))
+        return
+    max_workers = int(os.environ.get("CFN_MOD_CONCURRENCY", "10"))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(
+            executor.map(
+                lambda mod: install_module("modules", bucket, *mod, keys=keys), mods
+            )
+        )
 
 
 @cli.command()
 @click.option("--bucket", "-b", required=True)
-def publish(bucket):
+@click.option(
+    "--flat-key/--no-flat-key",
+    default=True,
+    help="Also write the unsharded artifact key read by older cfn-mod releases.",
+)
+def publish(bucket, flat_key):
     # load configuration
-    with open("module.yml", "r") as f:
-        conf = yaml.load(f, Loader=yaml.FullLoader)
+    conf = load_yaml("module.yml")
     module_name = conf["module"]["name"]
     now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     build_number = os.environ.get(
@@ -394,40 +908,94 @@ def publish(bucket):
     version = f'{conf["module"]["version"]}.{build_number}'
     # entrypoint = conf["module"]["entrypoint"]
     # Check published version
-    latest_version, latest_md5sum = get_latest_details(bucket, module_name)
+    latest_version, latest_digest, latest_algo = get_latest_details(
+        bucket, module_name
+    )
     all_files, md5_files = collect_files(conf["module"]["artifacts"])
-    click.echo("# Calculating md5 sum")
-    new_md5sum = calc_md5(md5_files)
-    if version == latest_version and new_md5sum == latest_md5sum:
-        click.echo(f"Version {version} and md5 sum {latest_md5sum} MATCH. Quitting.")
+    click.echo(f"# Calculating {DIGEST_ALGO} digest")
+    new_digest = calc_digest(md5_files)
+    current_digest = new_digest
+    if latest_digest is not None and latest_algo == "zip-md5":
+        click.echo(f"# Calculating {latest_algo} digest for comparison")
+        current_digest = calc_zip_md5(md5_files)
+    if version == latest_version and current_digest == latest_digest:
+        click.echo(f"Version {version} and digest {latest_digest} MATCH. Quitting.")
         sys.exit(0)
-    elif version == latest_version and new_md5sum != latest_md5sum:
+    elif version == latest_version and current_digest != latest_digest:
         click.echo(
             f"Building version {version}, but version matches latest published"
-            " and the md5 sums DO NOT match.  Quitting."
+            " and the digests DO NOT match.  Quitting."
         )
         sys.exit(1)
-    elif new_md5sum == latest_md5sum:
+    elif current_digest == latest_digest:
         click.echo(
             f"Artifacts match existing latest version {latest_version}. Quitting."
         )
         sys.exit(0)
-    key = (
-        f"modules/dev/{module_name}-{version}.zip"
-        if "dev" in version
-        else f"modules/{module_name}-{version}.zip"
-    )
+    key = module_key(module_name, version)
     click.echo("# Creating zip file")
-    artifact_zip = create_zip(all_files, version)
-    s3 = boto3.client("s3", config=session_config)
-    click.echo("# Writing artifact")
-    s3.put_object(Body=artifact_zip.getvalue(), Bucket=bucket, Key=key)
+    s3 = get_client()
+    with create_zip(all_files, version) as artifact_zip:
+        click.echo("# Writing artifact")
+        s3.upload_fileobj(artifact_zip, bucket, key, Config=transfer_config)
     click.echo(f"# Artifact written to s3://{bucket}/{key}")
+    if flat_key:
+        # Server-side copy, so the artifact is only uploaded once
+        source = {"Bucket": bucket, "Key": key}
+        key = module_key(module_name, version, sharded=False)
+        s3.copy(source, bucket, key, Config=transfer_config)
+        click.echo(f"# Artifact copied to s3://{bucket}/{key}")
     if "dev" not in version:
         click.echo(f"# Updating {module_name} module latest details")
-        latest = {"version": version, "md5sum": new_md5sum}
-        key = f"latest/{module_name}-latest.yml"
-        s3.put_object(Body=yaml.dump(latest).encode("utf-8"), Bucket=bucket, Key=key)
+        # JSON strings are valid YAML scalars and keep versions such as 1.5
+        # from reading back as numbers. Older cfn-mod releases fail to read
+        # latest details without an md5sum.
+        latest = (
+            f"version: {json.dumps(version)}\n"
+            f"digest: {json.dumps(new_digest)}\n"
+            f"algo: {json.dumps(DIGEST_ALGO)}\n"
+            "md5sum: null\n"
+        )
+        key = latest_key(module_name)
+        s3.put_object(Body=latest.encode("utf-8"), Bucket=bucket, Key=key)
+
+
+def module_name_from_key(key, module_names):
+    filename = key.rsplit("/", 1)[-1][: -len(".zip")]
+    # Names may contain dashes, so prefer the longest published module name
+    candidates = [name for name in module_names if filename.startswith(f"{name}-")]
+    if candidates:
+        return max(candidates, key=len)
+    return filename.rsplit("-", 1)[0]
+
+
+@cli.command()
+@click.option("--bucket", "-b", required=True)
+def migrate(bucket):
+    s3 = get_client()
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = set()
+    for page in paginator.paginate(Bucket=bucket, Prefix="modules/"):
+        keys.update(item["Key"] for item in page.get("Contents", []))
+    module_names = set()
+    for page in paginator.paginate(Bucket=bucket, Prefix="latest/"):
+        module_names.update(
+            item["Key"][len("latest/") : -len("-latest.yml")]
+            for item in page.get("Contents", [])
+            if item["Key"].endswith("-latest.yml")
+        )
+    # Flat keys are left in place for older cfn-mod releases
+    for key in sorted(keys):
+        match = re.fullmatch(r"(modules(?:/dev)?)/([^/]+\.zip)", key)
+        if not match:
+            continue
+        base, filename = match.groups()
+        module_name = module_name_from_key(key, module_names)
+        new_key = f"{base}/{module_shard(module_name)}/{filename}"
+        if new_key in keys:
+            continue
+        click.echo(f"Copying s3://{bucket}/{key} to s3://{bucket}/{new_key}")
+        s3.copy({"Bucket": bucket, "Key": key}, bucket, new_key, Config=transfer_config)
 
 
 if __name__ == "__main__":
@@ -1,20 +1,21 @@
-import json
+from pathlib import Path
 
 from setuptools import setup
 
-install_requires = []
-tests_require = []
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
-with open("Pipfile.lock") as fd:
-    lock_data = json.load(fd)
-    install_requires = [
-        package_name + package_data["version"]
-        for package_name, package_data in lock_data["default"].items()
-    ]
-    tests_require = [
-        package_name + package_data["version"]
-        for package_name, package_data in lock_data["develop"].items()
-    ]
+lock_data = loads(Path("Pipfile.lock").read_bytes())
+install_requires = [
+    package_name + package_data["version"]
+    for package_name, package_data in lock_data["default"].items()
+]
+tests_require = [
+    package_name + package_data["version"]
+    for package_name, package_data in lock_data["develop"].items()
+]
 
 setup(
     name="cfn-mod",
@@ -28,5 +29,6 @@ setup(
     zip_safe=False,
     install_requires=install_requires,
     tests_require=tests_require,
+    extras_require={"async": ["aioboto3"]},
     entry_points={"console_scripts": ["cfn-mod=cfnmod.__main__:main"]},
 )
@@ -1,2 +1,457 @@
+import asyncio
+import glob
+import hashlib
+import io
+import os
+import stat
+import zipfile
+from unittest import mock
+
+import botocore.exceptions
+import pytest
+import yaml
+from botocore.response import StreamingBody
+from click.testing import CliRunner
+
+from cfnmod import cfnmod
+
+MODULE_CONF = """\
+module:
+  name: demo
+  version: "1.0"
+  build_number_environment_variable: BUILD_NUMBER
+  entrypoint: main.yml
+  artifacts:
+    - pattern: ["*.yml", "scripts/*"]
+      include_in_md5: true
+"""
+
+
 def test_one() -> None:
     assert True
+
+
+@pytest.fixture
+def module_dir(tmp_path, monkeypatch):
+    (tmp_path / "module.yml").write_text(MODULE_CONF)
+    (tmp_path / "main.yml").write_text("Resources: {}\n")
+    (tmp_path / "scripts").mkdir()
+    script = tmp_path / "scripts" / "run.sh"
+    script.write_text("#!/bin/sh\necho hi\n")
+    script.chmod(0o755)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("BUILD_NUMBER", "7")
+    return tmp_path
+
+
+def baseline_zip_md5(md5_files):
+    # The md5 sum cfn-mod published before content digests were introduced
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w") as zip_file:
+        for folder, files in md5_files:
+            for path in files:
+                full_path = os.path.join(folder, path)
+                if not os.path.isfile(full_path):
+                    continue
+                permission = 0o555 if os.access(full_path, os.X_OK) else 0o444
+                zip_info = zipfile.ZipInfo.from_file(full_path, path)
+                zip_info.date_time = (2020, 1, 1, 0, 0, 0)
+                zip_info.external_attr = (stat.S_IFREG | permission) << 16
+                with open(full_path, "rb") as fp:
+                    zip_file.writestr(zip_info, fp.read())
+    return hashlib.md5(zip_bytes.getvalue()).hexdigest()
+
+
+def test_create_zip_is_rewound(module_dir) -> None:
+    with cfnmod.create_zip([(".", ["main.yml"])]) as zip_bytes:
+        assert zip_bytes.tell() == 0
+        assert zipfile.ZipFile(zip_bytes).namelist() == ["main.yml"]
+
+
+def test_create_zip_without_compresslevel(module_dir) -> None:
+    # Python 3.6 has no compresslevel, so zip_compression leaves it out there
+    compression = {"compress_type": zipfile.ZIP_DEFLATED}
+    with cfnmod.create_zip([(".", ["main.yml"])], compression=compression) as zip_bytes:
+        archive = zipfile.ZipFile(zip_bytes)
+        assert archive.getinfo("main.yml").compress_type == zipfile.ZIP_DEFLATED
+        assert archive.read("main.yml") == b"Resources: {}\n"
+
+
+def test_calc_zip_md5_matches_baseline(module_dir) -> None:
+    md5_files = [(".", ["main.yml", "module.yml", "scripts/run.sh"])]
+    assert cfnmod.calc_zip_md5(md5_files) == baseline_zip_md5(md5_files)
+
+
+def publish(latest_details, *args):
+    s3 = mock.MagicMock()
+    uploads = {}
+
+    def upload_fileobj(fileobj, bucket, key, **kwargs):
+        uploads[key] = fileobj.read()
+
+    s3.upload_fileobj.side_effect = upload_fileobj
+    with mock.patch.object(cfnmod, "get_client", return_value=s3), mock.patch.object(
+        cfnmod, "get_latest_details", return_value=latest_details
+    ):
+        result = CliRunner().invoke(cfnmod.cli, ["publish", "-b", "bucket", *args])
+    return result, s3, uploads
+
+
+def test_publish_uploads_readable_zip(module_dir) -> None:
+    result, s3, uploads = publish((None, None, None))
+    assert result.exit_code == 0, result.output
+    key = cfnmod.module_key("demo", "1.0.7")
+    archive = zipfile.ZipFile(io.BytesIO(uploads[key]))
+    assert sorted(archive.namelist()) == ["main.yml", "module.yml", "scripts/run.sh"]
+    module_conf = yaml.safe_load(archive.read("module.yml"))
+    assert module_conf["module"]["version"] == "1.0.7"
+    assert archive.read("main.yml") == b"Resources: {}\n"
+    s3.copy.assert_called_once_with(
+        {"Bucket": "bucket", "Key": key},
+        "bucket",
+        cfnmod.module_key("demo", "1.0.7", sharded=False),
+        Config=cfnmod.transfer_config,
+    )
+
+
+def test_publish_without_flat_key(module_dir) -> None:
+    result, s3, uploads = publish((None, None, None), "--no-flat-key")
+    assert result.exit_code == 0, result.output
+    assert list(uploads) == [cfnmod.module_key("demo", "1.0.7")]
+    s3.copy.assert_not_called()
+
+
+def test_install_deduplicates_modules() -> None:
+    with mock.patch.object(
+        cfnmod, "install_module"
+    ) as install_module, mock.patch.object(cfnmod, "list_keys", return_value=None):
+        result = CliRunner().invoke(
+            cfnmod.cli, ["install", "-b", "bucket", "foo", "bar", "foo==1.2"]
+        )
+    assert result.exit_code == 0, result.output
+    calls = sorted(call[0][2:4] for call in install_module.call_args_list)
+    assert calls == [("bar", None), ("foo", "1.2")]
+
+
+@pytest.fixture
+def glob_tree(tmp_path, monkeypatch):
+    tree = tmp_path / "tree"
+    for path in [
+        "x.yml",
+        "y.json",
+        ".hidden.yml",
+        "a/z.yml",
+        "a/.dot",
+        "a/b/w.yml",
+        "a/b/c/v.js",
+        ".hid/r.yml",
+        "d/[x].yml",
+    ]:
+        (tree / path).parent.mkdir(parents=True, exist_ok=True)
+        (tree / path).write_text(path)
+    (tree / "d" / "link").symlink_to(tree / "a", target_is_directory=True)
+    monkeypatch.chdir(tree)
+    return tree
+
+
+@pytest.mark.parametrize("recursive", [False, True])
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "*",
+        "**",
+        "**/*",
+        "**/*.yml",
+        ".*",
+        "**/.*",
+        "a/**/*.yml",
+        "?.yml",
+        "[xy].*",
+        "[!x].*",
+        "*/*",
+        "d/*",
+        "d/**",
+        "d/link/**/*.yml",
+        ".hid/*",
+        "d/[[]x].yml",
+        "a/",
+        "./*.yml",
+        "./a/**/*.yml",
+        "../tree/*.yml",
+        "a/../x.yml",
+        "x.yml",
+        "missing",
+    ],
+)
+def test_collect_files_matches_glob(glob_tree, pattern, recursive) -> None:
+    expected = sorted(
+        path for path in glob.glob(pattern, recursive=recursive) if os.path.isfile(path)
+    )
+    full, md5 = cfnmod.collect_files(
+        [{"pattern": [pattern], "recursive": recursive, "include_in_md5": True}]
+    )
+    assert full == [(".", expected)]
+    assert md5 == [(".", expected)]
+
+
+def test_collect_files_from_folder(glob_tree) -> None:
+    full, md5 = cfnmod.collect_files(
+        [
+            {"pattern": ["*.yml"]},
+            {"folder": "a", "pattern": ["**/*.yml", "./*"], "recursive": True},
+        ]
+    )
+    assert full == [(".", ["x.yml"]), ("a", ["./z.yml", "b/w.yml", "z.yml"])]
+    assert md5 == [(".", []), ("a", [])]
+
+
+def test_collect_files_rejects_missing_folder(glob_tree) -> None:
+    with pytest.raises(FileNotFoundError):
+        cfnmod.collect_files([{"folder": "does-not-exist", "pattern": ["*"]}])
+
+
+def test_list_folder_skips_hidden_directories(glob_tree) -> None:
+    assert ".hid/r.yml" not in cfnmod.list_folder(".")
+    assert ".hidden.yml" in cfnmod.list_folder(".")
+    assert ".hid/r.yml" in cfnmod.list_folder(".", hidden=True)
+
+
+def list_pages(*pages):
+    paginator = mock.MagicMock()
+    paginator.paginate.side_effect = lambda Bucket, Prefix: [
+        {"Contents": [{"Key": f"{Prefix}{key}", "ETag": '"e"'} for key in page]}
+        for page in pages
+    ]
+    s3 = mock.MagicMock()
+    s3.get_paginator.return_value = paginator
+    return mock.patch.object(cfnmod, "get_unsigned_client", return_value=s3)
+
+
+def test_list_keys_gives_up_past_max_pages() -> None:
+    with list_pages(["a"], ["b"]):
+        assert cfnmod.list_keys("bucket", ["latest/"], max_pages=1) is None
+        assert cfnmod.list_keys("bucket", ["latest/"], max_pages=2) == {
+            "latest/a": '"e"',
+            "latest/b": '"e"',
+        }
+
+
+@pytest.mark.parametrize("count,listed", [(2, False), (11, False), (12, True)])
+def test_install_lists_only_when_cheaper(count, listed) -> None:
+    modules = [f"mod{index}" for index in range(count)]
+    with mock.patch.object(cfnmod, "install_module"), mock.patch.object(
+        cfnmod, "list_keys", return_value=None
+    ) as list_keys:
+        result = CliRunner().invoke(cfnmod.cli, ["install", "-b", "bucket", *modules])
+    assert result.exit_code == 0, result.output
+    assert list_keys.called == listed
+
+
+@pytest.mark.parametrize(
+    "document,expected",
+    [
+        ("version: 1.0.7\nmd5sum: abc\n", ("1.0.7", "abc", "zip-md5")),
+        (
+            'version: "1.5"\ndigest: "def"\nalgo: "sha256"\nmd5sum: null\n',
+            ("1.5", "def", "sha256"),
+        ),
+    ],
+)
+def test_parse_latest_details(document, expected) -> None:
+    assert cfnmod.parse_latest_details(io.BytesIO(document.encode())) == expected
+
+
+MODULE_MD5_FILES = [(".", ["main.yml", "module.yml", "scripts/run.sh"])]
+
+
+@pytest.mark.parametrize(
+    "algo,calc", [("zip-md5", baseline_zip_md5), ("sha256", cfnmod.calc_digest)]
+)
+@pytest.mark.parametrize("version", ["1.0.7", "1.0.6"])
+def test_publish_skips_unchanged_module(module_dir, algo, calc, version) -> None:
+    result, s3, uploads = publish((version, calc(MODULE_MD5_FILES), algo))
+    assert result.exit_code == 0, result.output
+    assert "MATCH" in result.output or "Artifacts match" in result.output
+    assert uploads == {}
+    s3.put_object.assert_not_called()
+
+
+def test_publish_rejects_changed_module_at_same_version(module_dir) -> None:
+    result, s3, uploads = publish(("1.0.7", "0" * 32, "zip-md5"))
+    assert result.exit_code == 1
+    assert uploads == {}
+
+
+def module_zip():
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w") as zip_file:
+        zip_file.writestr("main.yml", "Resources: {}\n")
+    return zip_bytes.getvalue()
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, "GetObject")
+
+
+def test_download_attempts() -> None:
+    sharded, flat = cfnmod.module_keys("demo", "1.0.7")
+    attempts = cfnmod.download_attempts("demo", "1.0.7", None, '"e"')
+    assert attempts == [(sharded, cfnmod.DENIED_CODES), (flat, ())]
+    listed = {flat: '"e"'}
+    assert cfnmod.download_attempts("demo", "1.0.7", listed, None) == [(flat, ())]
+    attempts = cfnmod.download_attempts("demo", "1.0.7", listed, '"e"')
+    assert attempts is cfnmod.NOT_MODIFIED
+    listed = {sharded: '"e"'}
+    attempts = cfnmod.download_attempts("demo", "1.0.7", listed, None)
+    assert attempts == [(sharded, cfnmod.DENIED_CODES)]
+    assert cfnmod.download_attempts("demo", "1.0.7", {}, None) == []
+
+
+def test_install_module_downloads_with_one_get(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    data = module_zip()
+    s3 = mock.MagicMock()
+    s3.get_object.return_value = {
+        "Body": StreamingBody(io.BytesIO(data), len(data)),
+        "ETag": '"abc"',
+    }
+    with mock.patch.object(cfnmod, "get_unsigned_client", return_value=s3):
+        assert cfnmod.install_module("modules", "bucket", "demo", "1.0.7") == "1.0.7"
+    s3.get_object.assert_called_once_with(
+        Bucket="bucket", Key=cfnmod.module_key("demo", "1.0.7")
+    )
+    s3.head_object.assert_not_called()
+    assert (tmp_path / "modules" / "demo" / "main.yml").read_text() == "Resources: {}\n"
+    assert (tmp_path / "modules" / "demo" / ".etag").read_text() == '"abc"'
+
+
+def test_install_module_skips_unchanged_module(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    installed = tmp_path / "modules" / "demo"
+    installed.mkdir(parents=True)
+    (installed / ".etag").write_text('"abc"')
+    (installed / "main.yml").write_text("local\n")
+    s3 = mock.MagicMock()
+    s3.get_object.side_effect = client_error("304")
+    with mock.patch.object(cfnmod, "get_unsigned_client", return_value=s3):
+        assert cfnmod.install_module("modules", "bucket", "demo", "1.0.7") == "1.0.7"
+    s3.get_object.assert_called_once_with(
+        Bucket="bucket", Key=cfnmod.module_key("demo", "1.0.7"), IfNoneMatch='"abc"'
+    )
+    assert (installed / "main.yml").read_text() == "local\n"
+
+
+class AsyncBody:
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start : start + chunk_size]
+
+
+def test_install_module_async(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    data = module_zip()
+    requests = []
+
+    class S3:
+        async def get_object(self, **kwargs):
+            requests.append(kwargs)
+            if kwargs["Key"].startswith("latest/"):
+                return {
+                    "Body": AsyncBody(b"version: 1.0.7\nmd5sum: abc\n"),
+                    "ETag": "l",
+                }
+            return {"Body": AsyncBody(data), "ETag": '"abc"'}
+
+    async def install():
+        semaphore = asyncio.Semaphore(2)
+        return await cfnmod.install_module_async(
+            S3(), semaphore, "modules", "bucket", "demo"
+        )
+
+    assert cfnmod.run_async(install()) == "1.0.7"
+    assert [request["Key"] for request in requests] == [
+        "latest/demo-latest.yml",
+        cfnmod.module_key("demo", "1.0.7"),
+    ]
+    assert (tmp_path / "modules" / "demo" / "main.yml").read_text() == "Resources: {}\n"
+    assert (tmp_path / "modules" / "demo" / ".etag").read_text() == '"abc"'
+
+
+@pytest.mark.parametrize("code", ["404", "403"])
+def test_install_module_falls_back_to_flat_key(tmp_path, monkeypatch, code) -> None:
+    monkeypatch.chdir(tmp_path)
+    data = module_zip()
+    s3 = mock.MagicMock()
+    s3.get_object.side_effect = [
+        client_error(code),
+        {"Body": StreamingBody(io.BytesIO(data), len(data)), "ETag": '"abc"'},
+    ]
+    with mock.patch.object(cfnmod, "get_unsigned_client", return_value=s3):
+        assert cfnmod.install_module("modules", "bucket", "demo", "1.0.7") == "1.0.7"
+    assert [call[1]["Key"] for call in s3.get_object.call_args_list] == [
+        cfnmod.module_key("demo", "1.0.7"),
+        cfnmod.module_key("demo", "1.0.7", sharded=False),
+    ]
+    assert (tmp_path / "modules" / "demo" / "main.yml").exists()
+
+
+def test_install_module_reports_denied_flat_key(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    s3 = mock.MagicMock()
+    s3.get_object.side_effect = [client_error("403"), client_error("403")]
+    with mock.patch.object(cfnmod, "get_unsigned_client", return_value=s3):
+        with pytest.raises(botocore.exceptions.ClientError):
+            cfnmod.install_module("modules", "bucket", "demo", "1.0.7")
+
+
+@pytest.mark.parametrize(
+    "key,expected",
+    [
+        ("modules/my-mod-1.0.1.zip", "my-mod"),
+        ("modules/my-mod-extra-1.0.1.zip", "my-mod-extra"),
+        ("modules/dev/my-mod-1.0.dev20200101.zip", "my-mod"),
+        ("modules/dev/dev-only-1.0.dev20200101.zip", "dev-only"),
+    ],
+)
+def test_module_name_from_key(key, expected) -> None:
+    assert cfnmod.module_name_from_key(key, {"my-mod", "my-mod-extra"}) == expected
+
+
+def test_migrate_copies_flat_keys_to_sharded_keys() -> None:
+    flat = [
+        cfnmod.module_key("my-mod", "1.0.1", sharded=False),
+        cfnmod.module_key("my-mod", "1.0.dev20200101", sharded=False),
+        cfnmod.module_key("dev-only", "1.0.dev20200101", sharded=False),
+        cfnmod.module_key("done", "1.0.1", sharded=False),
+    ]
+    listing = {
+        "modules/": flat
+        + [cfnmod.module_key("done", "1.0.1"), cfnmod.module_key("new", "1.0.1")],
+        "latest/": ["latest/my-mod-latest.yml", "latest/done-latest.yml"],
+    }
+    paginator = mock.MagicMock()
+    paginator.paginate.side_effect = lambda Bucket, Prefix: [
+        {"Contents": [{"Key": key} for key in listing[Prefix]]}
+    ]
+    s3 = mock.MagicMock()
+    s3.get_paginator.return_value = paginator
+    with mock.patch.object(cfnmod, "get_client", return_value=s3):
+        result = CliRunner().invoke(cfnmod.cli, ["migrate", "-b", "bucket"])
+    assert result.exit_code == 0, result.output
+    expected = [
+        (flat[2], cfnmod.module_key("dev-only", "1.0.dev20200101")),
+        (flat[1], cfnmod.module_key("my-mod", "1.0.dev20200101")),
+        (flat[0], cfnmod.module_key("my-mod", "1.0.1")),
+    ]
+    assert s3.copy.call_args_list == [
+        mock.call(
+            {"Bucket": "bucket", "Key": old},
+            "bucket",
+            new,
+            Config=cfnmod.transfer_config,
+        )
+        for old, new in expected
+    ]